@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2021, Florian Schanda                         ##
+##              Copyright (C) 2021-2026, Florian Schanda                    ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
 ##                                                                          ##
@@ -301,7 +301,7 @@ class MH_Copyright(command_line.MISS_HIT_Back_End):
             return MH_Copyright_Result(wp, False)
 
         if action_taken:
-            wp.write_modified("\n".join(lines) + "\n")
+            wp.write_modified(line + "\n" for line in lines)
 
         return MH_Copyright_Result(wp, True)
 
@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2020-2021, Florian Schanda                    ##
+##              Copyright (C) 2020-2026, Florian Schanda                    ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
 ##                                                                          ##
@@ -380,14 +380,21 @@ def execute(mh, options, extra_options, back_end,
                     back_end.process_result(result)
 
     else:
-        pool = multiprocessing.Pool()
-        for results in pool.imap(process_fn, work_list, 5):
-            for result in results:
-                assert isinstance(result, work_package.Result)
-                mh.integrate(result.wp.mh)
-                if result.processed:
-                    mh.finalize_file(result.wp.filename)
-                    back_end.process_result(result)
+        # We hand out work in chunks, so that large projects do not
+        # pay for a round-trip to a worker for every few files, but
+        # keep enough chunks (about four per worker) to balance the
+        # load when some files are much bigger than others.
+        n_workers = os.cpu_count() or 1
+        chunksize = max(1, len(work_list) // (4 * n_workers))
+
+        with multiprocessing.Pool(n_workers) as pool:
+            for results in pool.imap(process_fn, work_list, chunksize):
+                for result in results:
+                    assert isinstance(result, work_package.Result)
+                    mh.integrate(result.wp.mh)
+                    if result.processed:
+                        mh.finalize_file(result.wp.filename)
+                        back_end.process_result(result)
 
     # Call hook for final work and issue summary message
 
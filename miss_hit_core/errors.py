@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2019-2021, Florian Schanda                    ##
+##              Copyright (C) 2019-2026, Florian Schanda                    ##
 ##              Copyright (C) 2019, Zenuity AB                              ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
@@ -42,6 +42,13 @@ class Location:
     * context is a replication of the line that contains the offending
       construct
     """
+    __slots__ = ("filename",
+                 "blockname",
+                 "line",
+                 "col_start",
+                 "col_end",
+                 "context")
+
     def __init__(self,
                  filename,
                  line=None,
@@ -59,9 +66,13 @@ class Location:
                                    col_start is not None)
         assert context is None or isinstance(context, str)
 
-        self.filename = filename.replace("\\", "/")
+        if "\\" in filename:
+            self.filename = sys.intern(filename.replace("\\", "/"))
+        else:
+            self.filename = filename
         # We canonicalise filenames so that windows and linux produce
-        # the same output.
+        # the same output. There is a location for every token, so
+        # for windows paths we make sure they share the same string.
 
         self.blockname = blockname
 
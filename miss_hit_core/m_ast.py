@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2019-2021, Florian Schanda                    ##
+##              Copyright (C) 2019-2026, Florian Schanda                    ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
 ##                                                                          ##
@@ -26,6 +26,7 @@
 import subprocess
 import re
 import os
+import functools
 
 from copy import copy
 
@@ -56,63 +57,80 @@ assert TOKENS_WITH_IMPLICIT_VALUE <= TOKEN_KINDS
 
 
 class Autofix_Instruction:
-    def __init__(self):
-        self.ensure_trim_before = False
-        self.ensure_trim_after  = False
-        self.ensure_ws_before   = False
-        self.ensure_ws_after    = False
-        # Control whitespace before/after token
+    # Most tokens never need fixing, so all instructions default to
+    # these class attributes and only the ones we actually set get
+    # stored on the instance.
+    ensure_trim_before = False
+    ensure_trim_after  = False
+    ensure_ws_before   = False
+    ensure_ws_after    = False
+    # Control whitespace before/after token
 
-        self.ensure_maxgap_before = False
-        self.ensure_maxgap_after  = False
-        # Make sure there is at most 1 whitespace around this token
+    ensure_maxgap_before = False
+    ensure_maxgap_after  = False
+    # Make sure there is at most 1 whitespace around this token
 
-        self.delete = False
-        # Remove this token
+    delete = False
+    # Remove this token
 
-        self.correct_indent = None
-        # The correct level of indentation
+    correct_indent = None
+    # The correct level of indentation
 
-        self.replace_with_newline = False
-        # For CONTINUATION tokens. Means this continuation should be
-        # just a newline (or comment) instead.
+    replace_with_newline = False
+    # For CONTINUATION tokens. Means this continuation should be
+    # just a newline (or comment) instead.
 
-        self.change_to_semicolon = False
-        # Replace this (comma) token with a semicolon
+    change_to_semicolon = False
+    # Replace this (comma) token with a semicolon
 
-        self.add_semicolon_after = False
-        # Insert a new semicolon after this token
+    add_semicolon_after = False
+    # Insert a new semicolon after this token
 
-        self.add_newline = False
-        # Insert a newline after this token.
+    add_newline = False
+    # Insert a newline after this token.
 
-        # The following are not fixes as such, but extra annotation to
-        # produce fixes.
+    # The following are not fixes as such, but extra annotation to
+    # produce fixes.
 
-        self.binary_operator = False
-        self.unary_operator  = False
-        # Classification if this token is a unary or binary
-        # operator. Only set for OPERATOR tokens.
+    binary_operator = False
+    unary_operator  = False
+    # Classification if this token is a unary or binary
+    # operator. Only set for OPERATOR tokens.
 
-        self.spurious = False
-        # Classification for spurious tokens. Specifically this can be
-        # set on commas so that mh_style can remove them.
+    spurious = False
+    # Classification for spurious tokens. Specifically this can be
+    # set on commas so that mh_style can remove them.
 
-        self.statement_terminator = False
-        # Classification if this comma/semicolon token actually ends a
-        # statement. I.e. not true for the punctuation inside matrices
-        # or cells.
+    statement_terminator = False
+    # Classification if this comma/semicolon token actually ends a
+    # statement. I.e. not true for the punctuation inside matrices
+    # or cells.
 
-        self.flag_continuations = False
-        # Set in cases where continuations following this token would
-        # be highly problematic
+    flag_continuations = False
+    # Set in cases where continuations following this token would
+    # be highly problematic
 
-        self.make_shortcircuit_explicit = False
-        # Set for & and | inside if/while guards to change them into
-        # the explicit short-circuit form && or ||
+    make_shortcircuit_explicit = False
+    # Set for & and | inside if/while guards to change them into
+    # the explicit short-circuit form && or ||
 
 
 class MATLAB_Token:
+    # There is one of these for every token in every file, so we
+    # avoid the per-instance dictionary.
+    __slots__ = ("kind",
+                 "raw_text",
+                 "location",
+                 "first_in_line",
+                 "first_in_statement",
+                 "anonymous",
+                 "contains_quotes",
+                 "block_comment",
+                 "annotation",
+                 "value",
+                 "fix",
+                 "ast_link")
+
     def __init__(self,
                  kind,
                  raw_text,
@@ -219,6 +237,8 @@ class Node:
         NODE_UID[0] += 1
         self.uid = NODE_UID[0]
         self.n_parent = None
+        self.indentation = None
+        # Cached result of get_indentation
 
     def loc(self):
         raise ICE("cannot produce error location")
@@ -277,15 +297,20 @@ class Node:
     def get_indentation(self):
         # Indentation is the same level as the parent. + 1 if the
         # parent itself causes children to be indented.
+        #
+        # This is only used once the tree is complete, and it is
+        # asked for every token, so we remember the answer.
+
+        if self.indentation is None:
+            if self.n_parent:
+                indent = self.n_parent.get_indentation()
+                if self.n_parent.causes_indentation():
+                    indent += 1
+            else:
+                indent = 0
+            self.indentation = indent
 
-        if self.n_parent:
-            indent = self.n_parent.get_indentation()
-            if self.n_parent.causes_indentation():
-                indent += 1
-        else:
-            indent = 0
-
-        return indent
+        return self.indentation
 
 
 ##############################################################################
@@ -505,7 +530,7 @@ class Script_File(Compilation_Unit):
         if cfg.active("naming_scripts"):
             regex = cfg.style_config["regex_script_name"]
             file_root = self.name.rsplit(".", 1)[0]
-            if not re.match("^(" + regex + ")$", file_root):
+            if not compile_naming_regex(regex).match(file_root):
                 mh.style_issue(self.loc(),
                                "violates naming scheme for scripts")
 
@@ -962,12 +987,26 @@ class Copyright_Info(Node):
         super().set_parent(n_parent)
 
 
+@functools.lru_cache(maxsize=None)
+def compile_naming_regex(regex):
+    # The naming regexes come from the configuration, but they are
+    # checked against every function, class, parameter, etc.
+    return re.compile("^(" + regex + ")$")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_copyright_regex(copyright_regex):
+    # There is normally just one copyright regex per project, but a
+    # docstring is created for every function and class.
+    return re.compile(copyright_regex)
+
+
 class Docstring(Node):
     def __init__(self, copyright_regex):
         super().__init__()
         assert isinstance(copyright_regex, str)
         self.l_comments = []
-        self.re_copyright = re.compile(copyright_regex)
+        self.re_copyright = compile_copyright_regex(copyright_regex)
 
         self.copyright_info = []
 
@@ -1778,7 +1817,7 @@ class Identifier(Name):
             return
 
         regex = cfg.style_config["regex_" + kind + "_name"]
-        if not re.match("^(" + regex + ")$", self.t_ident.value):
+        if not compile_naming_regex(regex).match(self.t_ident.value):
             mh.style_issue(self.t_ident.location,
                            "violates naming scheme for %s" % kind)
 
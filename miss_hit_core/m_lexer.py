@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2019-2022, Florian Schanda                    ##
+##              Copyright (C) 2019-2026, Florian Schanda                    ##
 ##              Copyright (C) 2019-2020, Zenuity AB                         ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
@@ -69,6 +69,17 @@ from miss_hit_core.m_language import KEYWORDS, ANNOTATION_KEYWORDS
 # a more traditional parser.
 
 
+# Characters that start a line comment, depending on the language
+# mode. These are shared by all lexers.
+MATLAB_COMMENT_CHARS = frozenset("%")
+OCTAVE_COMMENT_CHARS = frozenset("%#")
+CONFIG_COMMENT_CHARS = frozenset("#")
+
+# Decimal number literals, including exponents and imaginary suffixes
+RE_NUMBER = re.compile(r"([0-9]+(\.[0-9]*)?([eE][+-]?[0-9]+)?[iIjJ]?)|"
+                       r"(\.[0-9]+([eE][+-]?[0-9]+)?[iIjJ]?)")
+
+
 class Token_Generator(metaclass=ABCMeta):
     def __init__(self, filename, blockname=None):
         assert isinstance(filename, str)
@@ -164,7 +175,7 @@ class MATLAB_Lexer(Token_Generator):
         # things will be returned as strings, except for line
         # continuations. Comments and newlines end command form.
 
-        self.comment_char = frozenset("%")
+        self.comment_char = MATLAB_COMMENT_CHARS
         # Characters that start a line comment. MATLAB only uses %,
         # and Octave uses either.
 
@@ -202,11 +213,11 @@ class MATLAB_Lexer(Token_Generator):
 
     def set_octave_mode(self):
         self.octave_mode = True
-        self.comment_char = frozenset("%#")
+        self.comment_char = OCTAVE_COMMENT_CHARS
 
     def set_config_file_mode(self):
         self.config_file_mode = True
-        self.comment_char = frozenset("#")
+        self.comment_char = CONFIG_COMMENT_CHARS
         self.process_pragmas = False
 
     def line_count(self):
@@ -215,15 +226,10 @@ class MATLAB_Lexer(Token_Generator):
     def correct_tabs(self, tabwidth):
         assert isinstance(tabwidth, int) and tabwidth >= 2
 
-        new_lines = []
-        for line in self.context_line:
-            tmp = ""
-            for c in line:
-                if c == "\t":
-                    tmp += " " * (tabwidth - (len(tmp) % tabwidth))
-                else:
-                    tmp += c
-            new_lines.append(tmp)
+        # The lines come from splitlines, so they contain no line
+        # breaks and expandtabs' column counting matches ours exactly.
+        new_lines = [line.expandtabs(tabwidth)
+                     for line in self.context_line]
         self.context_line = new_lines
         self.text = "\n".join(new_lines) + "\n"
 
@@ -247,9 +253,11 @@ class MATLAB_Lexer(Token_Generator):
         for _ in range(n):
             self.skip()
 
-    def match_re(self, regex):
-        match = re.match("^" + regex,
-                         self.text[self.lexpos:])
+    def match_re(self, pattern):
+        # Match the compiled pattern in place, rather than on a copy
+        # of the rest of the file. Note that pattern.match anchors at
+        # the given position.
+        match = pattern.match(self.text, self.lexpos)
         if match is None:
             return None
         else:
@@ -581,9 +589,7 @@ class MATLAB_Lexer(Token_Generator):
                  self.cc == "." and self.nc.isnumeric():
                 # Its some kind of number
                 kind = "NUMBER"
-                tmp = self.match_re(
-                    r"([0-9]+(\.[0-9]*)?([eE][+-]?[0-9]+)?[iIjJ]?)|"
-                    r"(\.[0-9]+([eE][+-]?[0-9]+)?[iIjJ]?)")
+                tmp = self.match_re(RE_NUMBER)
 
                 if tmp.endswith("."):
                     # See bug #170. This is kinda a weird case. A
@@ -1341,6 +1347,13 @@ class Token_Buffer(Token_Generator):
                 token.fix.ensure_maxgap_before = True
 
     def replay(self):
+        return "".join(self.replay_iter())
+
+    def replay_iter(self):
+        # These are looked up for every token below
+        fix_indentation = self.cfg.active("indentation")
+        tab_width       = self.cfg.style_config["tab_width"]
+
         # Strip all tokens marked with delete
         new_tokens = []
         token_deleted = False
@@ -1374,11 +1387,11 @@ class Token_Buffer(Token_Generator):
 
                     # We might have to fix up indentation
                     if new_tokens[-1].first_in_statement and \
-                       self.cfg.active("indentation"):
+                       fix_indentation:
                         if new_tokens[-1].ast_link:
                             new_tokens[-1].fix.correct_indent = (
                                 new_tokens[-1].ast_link.get_indentation() *
-                                self.cfg.style_config["tab_width"])
+                                tab_width)
 
         # Add newlines
         tmp_tokens = new_tokens
@@ -1394,7 +1407,7 @@ class Token_Buffer(Token_Generator):
             # See bug_163 tests. This is hacky and probably due a
             # re-write.
             if token.first_in_statement and \
-               self.cfg.active("indentation") and \
+               fix_indentation and \
                token.ast_link:
                 current_block_indent = token.ast_link.get_indentation()
 
@@ -1405,20 +1418,20 @@ class Token_Buffer(Token_Generator):
                 newline_added = False
                 token.first_in_line = True
                 token.first_in_statement = True
-                if self.cfg.active("indentation"):
+                if fix_indentation:
                     if token.ast_link:
                         token.fix.correct_indent = (
                             token.ast_link.get_indentation() *
-                            self.cfg.style_config["tab_width"])
+                            tab_width)
                     elif previous_token.ast_link and \
                          not previous_token.ast_link.causes_indentation():
                         token.fix.correct_indent = (
                             previous_token.ast_link.get_indentation() *
-                            self.cfg.style_config["tab_width"])
+                            tab_width)
                     else:
                         token.fix.correct_indent = (
                             current_block_indent *
-                            self.cfg.style_config["tab_width"])
+                            tab_width)
 
             # This token requires a newline to be inserted.
             if token.fix.add_newline:
@@ -1451,9 +1464,15 @@ class Token_Buffer(Token_Generator):
             new_tokens.append(token)
             old_token = token
 
+        # The token stream is now fully fixed up, so nothing below
+        # can fail half-way through writing a file.
+        return self.regurgitate(new_tokens)
+
+    def regurgitate(self, new_tokens):
         # Regurgitate the processed tokens to re-create the source
-        # file, including comments
-        rv = ""
+        # file, including comments. We yield the text piece by piece,
+        # so that large files do not need to be built up in memory.
+        fix_indentation = self.cfg.active("indentation")
         for n, token in enumerate(new_tokens):
             if n + 1 < len(new_tokens):
                 next_token = new_tokens[n + 1]
@@ -1465,11 +1484,11 @@ class Token_Buffer(Token_Generator):
                 next_in_line = None
 
             if token.first_in_line:
-                if self.cfg.active("indentation") and \
+                if fix_indentation and \
                    token.fix.correct_indent is not None:
-                    rv += " " * token.fix.correct_indent
+                    yield " " * token.fix.correct_indent
                 else:
-                    rv += " " * token.location.col_start
+                    yield " " * token.location.col_start
 
             if token.kind == "NEWLINE":
                 amount = min(2, token.raw_text.count("\n"))
@@ -1478,14 +1497,14 @@ class Token_Buffer(Token_Generator):
                     # newline. This newline is inserted manually at
                     # the end
                     amount = 0
-                rv += "\n" * amount
+                yield "\n" * amount
             elif token.kind == "CONTINUATION":
-                rv += token.raw_text.rstrip() + "\n"
+                yield token.raw_text.rstrip() + "\n"
             else:
-                rv += token.raw_text.rstrip()
+                yield token.raw_text.rstrip()
 
             if token.fix.add_semicolon_after:
-                rv += ";"
+                yield ";"
 
             if next_in_line and next_in_line.kind != "NEWLINE":
                 gap = (next_in_line.location.col_start -
@@ -1516,10 +1535,8 @@ class Token_Buffer(Token_Generator):
                     else:
                         gap = min(gap, 1)
 
-                rv += " " * gap
-        rv += "\n"
-
-        return rv
+                yield " " * gap
+        yield "\n"
 
     def debug_validate_links(self):
         for token in self.tokens:
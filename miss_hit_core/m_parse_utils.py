@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2021, Florian Schanda                         ##
+##              Copyright (C) 2021-2026, Florian Schanda                    ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
 ##                                                                          ##
@@ -34,13 +34,15 @@ def parse_docstrings(mh, cfg, parse_tree, tbuf):
     assert isinstance(parse_tree, Compilation_Unit)
     assert isinstance(tbuf, Token_Buffer)
 
+    copyright_regex = cfg.style_config["copyright_regex"]
+
     # The compilation unit's docstring are the leading comments in the
     # file (if any).
 
     approaching_docstring = False
     in_docstring = tbuf.tokens and tbuf.tokens[0].kind == "COMMENT"
     if in_docstring:
-        ast_node = Docstring(cfg.style_config["copyright_regex"])
+        ast_node = Docstring(copyright_regex)
         parse_tree.set_docstring(ast_node)
     else:
         ast_node = None
@@ -75,5 +77,5 @@ def parse_docstrings(mh, cfg, parse_tree, tbuf):
             elif not isinstance(token.ast_link, Definition):
                 raise ICE("AST link is %s and not a Definition" %
                           token.ast_link.__class__.__name__)
-            ast_node = Docstring(cfg.style_config["copyright_regex"])
+            ast_node = Docstring(copyright_regex)
             token.ast_link.set_docstring(ast_node)
@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2019-2021, Florian Schanda                    ##
+##              Copyright (C) 2019-2026, Florian Schanda                    ##
 ##              Copyright (C) 2019-2020, Zenuity AB                         ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
@@ -29,6 +29,9 @@
 
 import os
 import re
+import string
+import functools
+import collections
 from copy import copy
 
 from abc import ABCMeta, abstractmethod
@@ -48,6 +51,8 @@ from miss_hit_core.m_parse_utils import parse_docstrings
 
 
 class Style_Rule(metaclass=ABCMeta):
+    __slots__ = ("name", "autofix", "mandatory")
+
     def __init__(self, name, autofix):
         assert isinstance(name, str)
         assert isinstance(autofix, bool)
@@ -57,6 +62,8 @@ class Style_Rule(metaclass=ABCMeta):
 
 
 class Style_Rule_File(Style_Rule):
+    __slots__ = ()
+
     def __init__(self, name):
         super().__init__(name, False)
 
@@ -66,10 +73,19 @@ class Style_Rule_File(Style_Rule):
 
 
 class Style_Rule_Line(Style_Rule):
+    __slots__ = ()
+
     @abstractmethod
     def apply(self, mh, cfg, filename, line_no, line):
         pass
 
+    def apply_batch(self, mh, cfg, filename, lines):
+        # Rules that can check all lines more efficiently than one at
+        # a time may override this.
+        apply = self.apply
+        for line_no, line in enumerate(lines, 1):
+            apply(mh, cfg, filename, line_no, line)
+
 
 class Rule_File_Length(Style_Rule_File):
     """Maximum file length
@@ -80,6 +96,8 @@ class Rule_File_Length(Style_Rule_File):
 
     """
 
+    __slots__ = ()
+
     parameters = {
         "file_length": {
             "type"    : int,
@@ -113,6 +131,8 @@ class Rule_File_EOF_Lines(Style_Rule_File):
 
     """
 
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("eof_newlines")
         self.mandatory = True
@@ -141,6 +161,8 @@ class Rule_Line_Length(Style_Rule_Line):
 
     """
 
+    __slots__ = ()
+
     parameters = {
         "line_length": {
             "type"    : int,
@@ -169,7 +191,7 @@ class Rule_Line_Length(Style_Rule_Line):
                            self.autofix)
 
 
-class Rule_Line_Blank_Lines(Style_Rule_Line):
+class Rule_File_Blank_Lines(Style_Rule_File):
     """Consecutive blank lines
 
     This rule allows a maximum of one blank line to separate code blocks.
@@ -177,21 +199,32 @@ class Rule_Line_Blank_Lines(Style_Rule_Line):
 
     """
 
+    __slots__ = ()
+
+    # A blank line that is immediately followed by another blank
+    # line. We match the first one, so that matches can't overlap.
+    RE_DOUBLE_BLANK = re.compile(r"^[^\S\n]*\n(?=[^\S\n]*$)",
+                                 re.MULTILINE)
+
     def __init__(self):
-        super().__init__("consecutive_blanks", True)
+        super().__init__("consecutive_blanks")
         self.mandatory = True
-        self.is_blank = False
+        self.autofix = True
 
-    def apply(self, mh, cfg, filename, line_no, line):
-        if len(line.strip()):
-            self.is_blank = False
-        elif self.is_blank:
+    def apply(self, mh, cfg, filename, full_text, lines):
+        # We scan the lines as split by the lexer (rather than
+        # full_text), so that line numbers agree with the other
+        # rules.
+        text = "\n".join(lines)
+        line_no = 1
+        pos = 0
+        for match in self.RE_DOUBLE_BLANK.finditer(text):
+            line_no += text.count("\n", pos, match.end())
+            pos = match.end()
             mh.style_issue(Location(filename,
                                     line_no),
                            "more than one consecutive blank line",
                            self.autofix)
-        else:
-            self.is_blank = True
 
 
 class Rule_Line_Tabs(Style_Rule_Line):
@@ -219,6 +252,8 @@ class Rule_Line_Tabs(Style_Rule_Line):
 
     """
 
+    __slots__ = ()
+
     parameters = {
         "tab_width": {
             "type"    : int,
@@ -237,11 +272,12 @@ class Rule_Line_Tabs(Style_Rule_Line):
         self.mandatory = True
 
     def apply(self, mh, cfg, filename, line_no, line):
-        if "\t" in line:
+        tab_pos = line.find("\t")
+        if tab_pos >= 0:
             mh.style_issue(Location(filename,
                                     line_no,
-                                    line.index("\t"),
-                                    line.index("\t"),
+                                    tab_pos,
+                                    tab_pos,
                                     line),
                            "tab is not allowed",
                            self.autofix)
@@ -257,28 +293,36 @@ class Rule_Line_Trailing_Whitesapce(Style_Rule_Line):
 
     """
 
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("trailing_whitespace", True)
         self.mandatory = True
 
     def apply(self, mh, cfg, filename, line_no, line):
-        if line.endswith(" "):
-            if len(line.strip()) == 0:
-                mh.style_issue(Location(filename,
-                                        line_no),
-                               "whitespace on blank line",
-                               self.autofix)
-            else:
-                mh.style_issue(Location(filename,
-                                        line_no,
-                                        len(line.rstrip()),
-                                        len(line),
-                                        line),
-                               "trailing whitespace",
-                               self.autofix)
+        rstripped = line.rstrip()
+        if len(rstripped) == len(line):
+            return
+
+        if not rstripped:
+            mh.style_issue(Location(filename,
+                                    line_no),
+                           "whitespace on blank line",
+                           self.autofix)
+        else:
+            mh.style_issue(Location(filename,
+                                    line_no,
+                                    len(rstripped),
+                                    len(line),
+                                    line),
+                           "trailing whitespace",
+                           self.autofix)
 
 
+@functools.lru_cache(maxsize=1)
 def get_rules():
+    # The rule hierarchy is fixed once this module is loaded, so we
+    # only need to discover it once.
     rules = {
         "on_file" : [],
         "on_line" : [],
@@ -322,6 +366,23 @@ def build_library(cfg, rules):
     return lib
 
 
+LIBRARY_CACHE = {}
+
+
+def get_library(cfg, rules):
+    # Rule instances carry no per-file state and build_library only
+    # depends on which rules are active, so files sharing the same
+    # rule selection can share the same library. The rule set is
+    # unpickled afresh in worker processes, so we key on the rule
+    # classes themselves (which pickle by reference) and not on the
+    # identity of the dictionary.
+    key = (tuple(rule for kind in rules for rule in rules[kind]),
+           frozenset(cfg.style_rules))
+    if key not in LIBRARY_CACHE:
+        LIBRARY_CACHE[key] = build_library(cfg, rules)
+    return LIBRARY_CACHE[key]
+
+
 ##############################################################################
 
 
@@ -345,6 +406,54 @@ KEYWORDS_WITH_WS = frozenset([
     "events",
 ])
 
+ASCII_LETTERS = frozenset(string.ascii_letters)
+
+
+def classify_pragma(raw_text):
+    """Classify MATLAB pragmas (such as %#codegen or %#ok)
+
+    Returns "pragma" for a well-formed pragma, "space_after_hash" for
+    %# ok, "space_before_hash" for % #ok, and None for anything that
+    is not a pragma.
+
+    """
+    if len(raw_text) < 3 or raw_text[0] != "%":
+        return None
+
+    if raw_text[1] == "#":
+        if raw_text[2] in ASCII_LETTERS:
+            return "pragma"
+        body = raw_text[2:].lstrip(" ")
+        if len(body) < len(raw_text) - 2 and body[:1] in ASCII_LETTERS:
+            return "space_after_hash"
+
+    elif raw_text[1] == " " and "#" in raw_text:
+        body = raw_text[1:].lstrip(" ")
+        if body[:1] == "#" and body[1:2] in ASCII_LETTERS:
+            return "space_before_hash"
+
+    return None
+
+
+# What the stage 3 handlers get to see around the token they check:
+# its index in the token buffer, the adjacent tokens, and the
+# adjacent tokens on the same line together with the whitespace
+# separating them (None if there is no such token).
+Token_Neighbourhood = collections.namedtuple(
+    "Token_Neighbourhood",
+    ["n",
+     "prev_token", "next_token",
+     "prev_in_line", "next_in_line",
+     "ws_before", "ws_after"])
+
+
+@functools.lru_cache(maxsize=1024)
+def indentation_message(correct_spaces, actual_spaces):
+    # Badly indented files produce the same handful of messages over
+    # and over again, so we share the strings between them.
+    return ("indentation not correct, should be %u spaces, not %u" %
+            (correct_spaces, actual_spaces))
+
 
 def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
     assert isinstance(mh, Message_Handler)
@@ -353,52 +462,533 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
     assert isinstance(fixed, bool)
     assert isinstance(valid_code, bool)
 
+    # Nothing to do for an empty token buffer
+    if not tbuf.tokens:
+        return
+
     # Some state needed to fix indentation
     statement_start_token = None
     current_indent = 0
     enclosing_ast = None
     bracket_stack = []
     relevant_brackets = set()
+    tab_width = cfg.style_config["tab_width"]
+    continuation_offset = tab_width // 2
+
+    # The set of active rules does not change while we walk the
+    # tokens, so we only look them up once.
+    chk_annotation_whitespace       = cfg.active("annotation_whitespace")
+    chk_dangerous_continuation      = cfg.active("dangerous_continuation")
+    chk_implicit_shortcircuit       = cfg.active("implicit_shortcircuit")
+    chk_indentation                 = cfg.active("indentation")
+    chk_no_starting_newline         = cfg.active("no_starting_newline")
+    chk_operator_after_continuation = cfg.active("operator_after_continuation")
+    chk_operator_whitespace         = cfg.active("operator_whitespace")
+    chk_spurious_row_comma          = cfg.active("spurious_row_comma")
+    chk_spurious_row_semicolon      = cfg.active("spurious_row_semicolon")
+    chk_unicode                     = cfg.active("unicode")
+    chk_useless_continuation        = cfg.active("useless_continuation")
+    chk_whitespace_around_functions = cfg.active("whitespace_around_functions")
+    chk_whitespace_assignment       = cfg.active("whitespace_assignment")
+    chk_whitespace_brackets         = cfg.active("whitespace_brackets")
+    chk_whitespace_colon            = cfg.active("whitespace_colon")
+    chk_whitespace_comma            = cfg.active("whitespace_comma")
+    chk_whitespace_comments         = cfg.active("whitespace_comments")
+    chk_whitespace_continuation     = cfg.active("whitespace_continuation")
+    chk_whitespace_keywords         = cfg.active("whitespace_keywords")
+    chk_whitespace_semicolon        = cfg.active("whitespace_semicolon")
+
+    # Likewise for the configuration used by the indentation and
+    # unicode checks.
+    check_indent    = valid_code and chk_indentation
+    encoding        = cfg.style_config["enforce_encoding"]
+    encode_comments = cfg.style_config["enforce_encoding_comments"]
+
+    # Block comment indicators, e.g. %{ and %}
+    block_comment_markers = frozenset(cc + cb
+                                      for cc in tbuf.comment_char
+                                      for cb in "{}")
 
     # Find out which brackets are relevant for us for aligning
     # continuations
-    if cfg.active("indentation"):
+    if chk_indentation:
         if cfg.style_config["align_round_brackets"]:
             relevant_brackets.add("BRA")
         if cfg.style_config["align_other_brackets"]:
             relevant_brackets.add("M_BRA")
             relevant_brackets.add("C_BRA")
 
-    for n, token in enumerate(tbuf.tokens):
-        if n - 1 >= 0:
-            prev_token = tbuf.tokens[n - 1]
-        else:
-            prev_token = None
+    # Each kind of token is checked by its own handler. The main loop
+    # below passes each handler the token and its neighbourhood (see
+    # Token_Neighbourhood).
+
+    # Corresponds to the old CodeChecker CommaWhitespace
+    # rule. CommaLineEndings is now folded into the new
+    # end_of_statements rule, which is much more strict and
+    # complete.
+    def check_comma(token, nbh):
+        fix = token.fix
+        loc = token.location
+
+        if chk_whitespace_comma:
+            fix.ensure_trim_before = True
+            fix.ensure_ws_after = True
+
+            if (nbh.next_in_line and nbh.ws_after == 0) or \
+               (nbh.prev_in_line and nbh.ws_before > 0):
+                mh.style_issue(loc,
+                               "comma cannot be preceeded by whitespace "
+                               "and must be followed by whitespace",
+                               fixed)
 
-        if n + 1 < len(tbuf.tokens):
-            next_token = tbuf.tokens[n + 1]
-        else:
-            next_token = None
+        if chk_spurious_row_comma and fix.spurious:
+            fix.delete = True
+            mh.style_issue(loc,
+                           "this comma is not required and can be removed",
+                           fixed)
+
+    def check_semicolon(token, nbh):
+        fix = token.fix
+        loc = token.location
+
+        if chk_whitespace_semicolon:
+            fix.ensure_trim_before = True
+            fix.ensure_ws_after = True
+
+            if (nbh.next_in_line and nbh.ws_after == 0) or \
+               (nbh.prev_in_line and nbh.ws_before > 0):
+                mh.style_issue(loc,
+                               "semicolon cannot be preceeded by "
+                               "whitespace and must be followed by "
+                               "whitespace",
+                               fixed)
 
-        if (prev_token and
-            prev_token.location.line == token.location.line):
-            prev_in_line = prev_token
-            ws_before = (token.location.col_start -
-                         prev_in_line.location.col_end) - 1
+        if chk_spurious_row_semicolon and fix.spurious:
+            fix.delete = True
+            mh.style_issue(loc,
+                           "this semicolon is not required and can "
+                           "be removed",
+                           fixed)
+
+    def check_colon(token, nbh):
+        fix = token.fix
+        loc = token.location
 
+        if chk_whitespace_colon:
+            if nbh.prev_in_line and nbh.prev_in_line.kind == "COMMA":
+                pass
+                # We don't deal with this here. If anything it's the
+                # problem of the comma whitespace rules.
+            elif nbh.next_in_line and \
+                 nbh.next_in_line.kind == "CONTINUATION":
+                # Special exception in the rare cases we
+                # continue a range expression
+                if nbh.prev_in_line and nbh.ws_before > 0:
+                    fix.ensure_trim_before = True
+                    mh.style_issue(loc,
+                                   "no whitespace before colon",
+                                   fixed)
+            elif (nbh.prev_in_line and nbh.ws_before > 0) or \
+                 (nbh.next_in_line and nbh.ws_after > 0):
+                fix.ensure_trim_before = True
+                fix.ensure_trim_after = True
+                mh.style_issue(loc,
+                               "no whitespace around colon"
+                               " allowed",
+                               fixed)
+
+    # Corresponds to the old CodeChecker EqualSignWhitespace rule
+    def check_assignment(token, nbh):
+        fix = token.fix
+        loc = token.location
+
+        if chk_whitespace_assignment:
+            fix.ensure_ws_before = True
+            fix.ensure_ws_after = True
+
+            if nbh.prev_in_line and nbh.ws_before == 0:
+                mh.style_issue(loc,
+                               "= must be preceeded by whitespace",
+                               fixed)
+            elif nbh.next_in_line and nbh.ws_after == 0:
+                mh.style_issue(loc,
+                               "= must be succeeded by whitespace",
+                               fixed)
+
+    # Corresponds to the old CodeChecker ParenthesisWhitespace and
+    # BracketsWhitespace rules
+    def check_opening_bracket(token, nbh):
+        if chk_whitespace_brackets and \
+           nbh.next_in_line and nbh.ws_after > 0 and \
+           nbh.next_in_line.kind != "CONTINUATION":
+            mh.style_issue(token.location,
+                           "%s must not be followed by whitespace" %
+                           token.raw_text,
+                           fixed)
+            token.fix.ensure_trim_after = True
+
+    def check_closing_bracket(token, nbh):
+        if chk_whitespace_brackets and \
+           nbh.prev_in_line and nbh.ws_before > 0:
+            mh.style_issue(token.location,
+                           "%s must not be preceeded by whitespace" %
+                           token.raw_text,
+                           fixed)
+            token.fix.ensure_trim_before = True
+
+    def check_keyword(token, nbh):
+        loc = token.location
+
+        # Corresponds to the old CodeChecker KeywordWhitespace rule
+        if chk_whitespace_keywords and \
+           token.value in KEYWORDS_WITH_WS and \
+           nbh.next_in_line and nbh.ws_after == 0:
+            mh.style_issue(loc,
+                           "keyword must be succeeded by whitespace",
+                           fixed)
+            token.fix.ensure_ws_after = True
+
+        # The remaining checks only apply to function and end, so
+        # most keywords can stop here.
+        if not chk_whitespace_around_functions or \
+           token.value not in ("function", "end"):
+            return
+
+        # Make sure we have whitespace _before_ the function
+        # keyword
+        if token.value == "function":
+            # There is a special exception here for comments
+            # before functions
+            true_fstart_token = token
+            true_fstart_prev_token = nbh.prev_token
+            for i in reversed(range(0, nbh.n)):
+                if tbuf.tokens[i].kind == "COMMENT" and \
+                   tbuf.tokens[i].first_in_line:
+                    true_fstart_token = tbuf.tokens[i]
+                    if i > 0:
+                        true_fstart_prev_token = tbuf.tokens[i - 1]
+                    else:
+                        true_fstart_prev_token = None
+                elif tbuf.tokens[i].kind == "NEWLINE" and \
+                     tbuf.tokens[i].value.count("\n") == 1:
+                    pass
+                else:
+                    break
+
+            if true_fstart_prev_token and \
+               not (true_fstart_prev_token.location.line + 1 <
+                    true_fstart_token.location.line):
+                true_fstart_prev_token.fix.add_newline = True
+                mh.style_issue(loc,
+                               "function should be preceeded by an empty"
+                               " line",
+                               fixed)
+
+        # Make sure we have whitespace _after_ the function end
+        if valid_code and \
+           token.value == "end" and \
+           isinstance(token.ast_link, Function_Definition):
+            # We first need to find the actual last token on this line
+            true_end_id = nbh.n
+            true_end_next = None
+            true_end_nl = None
+            for i in range(nbh.n + 1, len(tbuf.tokens)):
+                if tbuf.tokens[i].kind == "NEWLINE":
+                    true_end_nl = tbuf.tokens[i]
+                    break
+                elif tbuf.tokens[i].location.line == loc.line:
+                    true_end_id = i
+                else:
+                    break
+            true_end = tbuf.tokens[true_end_id]
+            for i in range(true_end_id + 1, len(tbuf.tokens)):
+                if tbuf.tokens[i].kind == "NEWLINE":
+                    pass
+                else:
+                    true_end_next = tbuf.tokens[i]
+                    break
+
+            if true_end_next and \
+               not (true_end.location.line + 1 <
+                    true_end_next.location.line):
+                mh.style_issue(loc,
+                               "function should be suceeded by an"
+                               " empty line",
+                               fixed)
+                if true_end_nl:
+                    true_end_nl.fix.add_newline = True
+                else:
+                    true_end.fix.add_newline = True
+
+    # Corresponds to the old CodeChecker CommentWhitespace rule
+    def check_comment(token, nbh):
+        loc = token.location
+
+        if chk_whitespace_comments:
+            comment_char = token.raw_text[0]
+            pragma = classify_pragma(token.raw_text)
+
+            if pragma == "pragma":
+                # Stuff like %#codegen or %#ok are pragmas and should
+                # not be subject to style checks
+                pass
+
+            elif token.raw_text.startswith("%|"):
+                # This is a miss-hit pragma, but we've not
+                # processed it. This is fine.
+                pass
+
+            elif token.block_comment:
+                # Ignore block comments
+                pass
+
+            elif token.raw_text.strip() in block_comment_markers:
+                # Leave block comment indicators alone
+                pass
+
+            elif pragma == "space_after_hash":
+                # This looks like a pragma, but there is a spurious
+                # space
+                mh.style_issue(loc,
+                               "MATLAB pragma must not contain whitespace "
+                               "between %# and the pragma",
+                               fixed)
+                token.raw_text = "%#" + token.raw_text[2:].strip()
+
+            elif pragma == "space_before_hash":
+                # This looks like a pragma that got "fixed" before we
+                # fixed our pragma handling
+                mh.style_issue(loc,
+                               "MATLAB pragma must not contain whitespace "
+                               "between % and the pragma",
+                               fixed)
+                token.raw_text = "%#" + token.raw_text.split("#", 1)[1]
+
+            else:
+                # Normal comments should contain whitespace
+                comment_body = token.raw_text.lstrip(comment_char)
+                if comment_body and not comment_body.startswith(" "):
+                    mh.style_issue(loc,
+                                   "comment body must be separated with "
+                                   "whitespace from the starting %s" %
+                                   comment_char,
+                                   fixed)
+                    token.raw_text = (comment_char * (len(token.raw_text) -
+                                                      len(comment_body)) +
+                                      " " +
+                                      comment_body)
+
+            # Make sure we have whitespace before each comment
+            if nbh.prev_in_line and nbh.ws_before == 0:
+                mh.style_issue(loc,
+                               "comment must be preceeded by whitespace",
+                               fixed)
+                token.fix.ensure_ws_before = True
+
+    def check_continuation(token, nbh):
+        fix = token.fix
+        loc = token.location
+
+        # Make sure we have whitespace before each line continuation
+        if chk_whitespace_continuation and \
+           nbh.prev_in_line and nbh.ws_before == 0:
+            mh.style_issue(loc,
+                           "continuation must be preceeded by whitespace",
+                           fixed)
+            fix.ensure_ws_before = True
+
+        if chk_operator_after_continuation and \
+           nbh.next_token and nbh.next_token.first_in_line and \
+           nbh.next_token.kind == "OPERATOR" and \
+           nbh.next_token.fix.binary_operator:
+            # Continuations should not start with operators unless
+            # its a unary.
+            mh.style_issue(nbh.next_token.location,
+                           "continuations should not start with binary "
+                           "operators")
+
+        if chk_useless_continuation:
+            if nbh.next_token and \
+               nbh.next_token.kind in ("NEWLINE", "COMMENT"):
+                # Continuations followed immediately by a new-line
+                # or comment are not actually helpful at all.
+                mh.style_issue(loc,
+                               "useless line continuation",
+                               fixed)
+                fix.replace_with_newline = True
+            elif nbh.prev_token and \
+                 nbh.prev_token.fix.statement_terminator:
+                mh.style_issue(loc,
+                               "useless line continuation",
+                               fixed)
+                fix.delete = True
+
+    def check_operator(token, nbh):
+        fix = token.fix
+        loc = token.location
+
+        if not chk_operator_whitespace:
+            pass
+        elif fix.unary_operator:
+            if (nbh.prev_in_line and nbh.ws_before > 0) and \
+               token.value in (".'", "'"):
+                mh.style_issue(loc,
+                               "suffix operator must not be preceeded by"
+                               " whitespace",
+                               fixed)
+                fix.ensure_trim_before = True
+            elif (nbh.next_in_line and nbh.ws_after > 0) and \
+                 token.value not in (".'", "'"):
+                mh.style_issue(loc,
+                               "unary operator must not be followed by"
+                               " whitespace",
+                               fixed)
+                fix.ensure_trim_after = True
+        elif fix.binary_operator:
+            if token.value in (".^", "^"):
+                if (nbh.prev_in_line and nbh.ws_before > 0) or \
+                   (nbh.next_in_line and nbh.ws_after > 0):
+                    mh.style_issue(loc,
+                                   "power binary operator"
+                                   " must not be surrounded by whitespace",
+                                   fixed)
+                    fix.ensure_trim_before = True
+                    fix.ensure_trim_after = True
+            else:
+                if (nbh.prev_in_line and nbh.ws_before == 0) or \
+                   (nbh.next_in_line and nbh.ws_after == 0):
+                    mh.style_issue(loc,
+                                   "non power binary operator"
+                                   " must be surrounded by whitespace",
+                                   fixed)
+                    fix.ensure_ws_before = True
+                    fix.ensure_ws_after = True
+
+        if valid_code and \
+           chk_implicit_shortcircuit and \
+           token.value in ("&", "|") and \
+           token.ast_link and \
+           isinstance(token.ast_link, Binary_Logical_Operation) and \
+           token.ast_link.short_circuit:
+            # This rule is *disabled* for now since it does not
+            # work in all circumstances. Curiously, this bug is
+            # shared by mlint which also mis-classifies & when
+            # applied to arrays.
+            #
+            # To fix this we need to perform semantic analysis and
+            # type inference. We're leaving this in for
+            # compatibility with miss_hit.cfg files that contain
+            # reference to this rules.
+            #
+            # mh.style_issue(token.location,
+            #                "implicit short-circuit operation due to"
+            #                " expression being contained in "
+            #                " if/while guard",
+            #                True)
+            # token.fix.make_shortcircuit_explicit = True
+            pass
+
+    def check_annotation(token, nbh):
+        if chk_annotation_whitespace:
+            token.fix.ensure_ws_after = True
+
+            if nbh.next_in_line and nbh.ws_after == 0:
+                mh.style_issue(token.location,
+                               "annotation indication must be succeeded"
+                               " by whitespace",
+                               fixed)
+
+    def check_newline(token, nbh):
+        if nbh.n == 0 and chk_no_starting_newline:
+            # Files should not *start* with newline(s)
+            mh.style_issue(token.location,
+                           "files should not start with a newline",
+                           fixed)
+            token.fix.delete = True
+
+    # Each handler, the token kinds it deals with, and the rules it
+    # implements. Handlers for which none of the rules are active
+    # would not do anything, so we don't call them at all.
+    handler_table = [
+        (("COMMA",),
+         check_comma,
+         (chk_whitespace_comma, chk_spurious_row_comma)),
+        (("SEMICOLON",),
+         check_semicolon,
+         (chk_whitespace_semicolon, chk_spurious_row_semicolon)),
+        (("COLON",),
+         check_colon,
+         (chk_whitespace_colon,)),
+        (("ASSIGNMENT",),
+         check_assignment,
+         (chk_whitespace_assignment,)),
+        (("BRA", "A_BRA", "M_BRA"),
+         check_opening_bracket,
+         (chk_whitespace_brackets,)),
+        (("KET", "A_KET", "M_KET"),
+         check_closing_bracket,
+         (chk_whitespace_brackets,)),
+        (("KEYWORD",),
+         check_keyword,
+         (chk_whitespace_keywords, chk_whitespace_around_functions)),
+        (("COMMENT",),
+         check_comment,
+         (chk_whitespace_comments,)),
+        (("CONTINUATION",),
+         check_continuation,
+         (chk_whitespace_continuation,
+          chk_operator_after_continuation,
+          chk_useless_continuation)),
+        (("OPERATOR",),
+         check_operator,
+         (chk_operator_whitespace, chk_implicit_shortcircuit)),
+        (("ANNOTATION",),
+         check_annotation,
+         (chk_annotation_whitespace,)),
+        (("NEWLINE",),
+         check_newline,
+         (chk_no_starting_newline,)),
+    ]
+    handlers = {kind: handler
+                for kinds, handler, rules in handler_table
+                if any(rules)
+                for kind in kinds}
+
+    # The whitespace between two adjacent tokens on the same line is
+    # both the whitespace after the first and before the second, so
+    # we work it out once for each pair (None if the tokens are on
+    # different lines).
+    tokens = tbuf.tokens
+    gaps = [(b.location.col_start - a.location.col_end) - 1
+            if a.location.line == b.location.line
+            else None
+            for a, b in zip(tokens, tokens[1:])]
+
+    # We walk the tokens with a sliding window, so that each
+    # iteration has the previous and next token (and the gaps to
+    # them) at hand.
+    window = zip([None] + tokens[:-1],
+                 tokens,
+                 tokens[1:] + [None],
+                 [None] + gaps,
+                 gaps + [None])
+
+    for n, (prev_token, token, next_token,
+            gap_before, gap_after) in enumerate(window):
+        kind = token.kind
+        fix  = token.fix
+        loc  = token.location
+
+        if gap_before is not None:
+            prev_in_line = prev_token
+            ws_before = gap_before
         else:
             prev_in_line = None
             ws_before = None
 
-        if (next_token and
-            next_token.location.line == token.location.line):
-            if next_token.kind == "NEWLINE":
-                next_in_line = None
-                ws_after = None
-            else:
-                next_in_line = next_token
-                ws_after = (next_in_line.location.col_start -
-                            token.location.col_end) - 1
+        if gap_after is not None and next_token.kind != "NEWLINE":
+            next_in_line = next_token
+            ws_after = gap_after
         else:
             next_in_line = None
             ws_after = None
@@ -431,7 +1021,7 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
             statement_start_token = token
 
         # Recognize justifications
-        if token.kind in ("COMMENT", "CONTINUATION"):
+        if kind in ("COMMENT", "CONTINUATION"):
             if "mh:ignore_style" in token.value:
                 mh.register_justification(token)
 
@@ -439,367 +1029,20 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
         if token.anonymous:
             continue
 
-        # Corresponds to the old CodeChecker CommaWhitespace
-        # rule. CommaLineEndings is now folded into the new
-        # end_of_statements rule, which is much more strict and
-        # complete.
-        if token.kind == "COMMA":
-            if cfg.active("whitespace_comma"):
-                token.fix.ensure_trim_before = True
-                token.fix.ensure_ws_after = True
-
-                if (next_in_line and ws_after == 0) or \
-                   (prev_in_line and ws_before > 0):
-                    mh.style_issue(token.location,
-                                   "comma cannot be preceeded by whitespace "
-                                   "and must be followed by whitespace",
-                                   fixed)
-
-            if cfg.active("spurious_row_comma") and token.fix.spurious:
-                token.fix.delete = True
-                mh.style_issue(token.location,
-                               "this comma is not required and can be removed",
-                               fixed)
-
-        elif token.kind == "SEMICOLON":
-            if cfg.active("whitespace_semicolon"):
-                token.fix.ensure_trim_before = True
-                token.fix.ensure_ws_after = True
-
-                if (next_in_line and ws_after == 0) or \
-                   (prev_in_line and ws_before > 0):
-                    mh.style_issue(token.location,
-                                   "semicolon cannot be preceeded by "
-                                   "whitespace and must be followed by "
-                                   "whitespace",
-                                   fixed)
-
-            if cfg.active("spurious_row_semicolon") and token.fix.spurious:
-                token.fix.delete = True
-                mh.style_issue(token.location,
-                               "this semicolon is not required and can "
-                               "be removed",
-                               fixed)
-
-        elif token.kind == "COLON":
-            if cfg.active("whitespace_colon"):
-                if prev_in_line and prev_in_line.kind == "COMMA":
-                    pass
-                    # We don't deal with this here. If anything it's the
-                    # problem of the comma whitespace rules.
-                elif next_in_line and \
-                     next_in_line.kind == "CONTINUATION":
-                    # Special exception in the rare cases we
-                    # continue a range expression
-                    if prev_in_line and ws_before > 0:
-                        token.fix.ensure_trim_before = True
-                        mh.style_issue(token.location,
-                                       "no whitespace before colon",
-                                       fixed)
-                elif (prev_in_line and ws_before > 0) or \
-                     (next_in_line and ws_after > 0):
-                    token.fix.ensure_trim_before = True
-                    token.fix.ensure_trim_after = True
-                    mh.style_issue(token.location,
-                                   "no whitespace around colon"
-                                   " allowed",
-                                   fixed)
-
-        # Corresponds to the old CodeChecker EqualSignWhitespace rule
-        elif token.kind == "ASSIGNMENT":
-            if cfg.active("whitespace_assignment"):
-                token.fix.ensure_ws_before = True
-                token.fix.ensure_ws_after = True
-
-                if prev_in_line and ws_before == 0:
-                    mh.style_issue(token.location,
-                                   "= must be preceeded by whitespace",
-                                   fixed)
-                elif next_in_line and ws_after == 0:
-                    mh.style_issue(token.location,
-                                   "= must be succeeded by whitespace",
-                                   fixed)
-
-        # Corresponds to the old CodeChecker ParenthesisWhitespace and
-        # BracketsWhitespace rules
-        elif token.kind in ("BRA", "A_BRA", "M_BRA"):
-            if cfg.active("whitespace_brackets") and \
-               next_in_line and ws_after > 0 and \
-               next_in_line.kind != "CONTINUATION":
-                mh.style_issue(token.location,
-                               "%s must not be followed by whitespace" %
-                               token.raw_text,
-                               fixed)
-                token.fix.ensure_trim_after = True
-
-        elif token.kind in ("KET", "A_KET", "M_KET"):
-            if cfg.active("whitespace_brackets") and \
-               prev_in_line and ws_before > 0:
-                mh.style_issue(token.location,
-                               "%s must not be preceeded by whitespace" %
-                               token.raw_text,
-                               fixed)
-                token.fix.ensure_trim_before = True
-
-        elif token.kind == "KEYWORD":
-            # Corresponds to the old CodeChecker KeywordWhitespace rule
-            if token.value in KEYWORDS_WITH_WS and \
-               cfg.active("whitespace_keywords") and \
-               next_in_line and ws_after == 0:
-                mh.style_issue(token.location,
-                               "keyword must be succeeded by whitespace",
-                               fixed)
-                token.fix.ensure_ws_after = True
-
-            # Make sure we have whitespace _before_ the function
-            # keyword
-            if token.value == "function" and \
-               cfg.active("whitespace_around_functions"):
-                # There is a special exception here for comments
-                # before functions
-                true_fstart_token = token
-                true_fstart_prev_token = prev_token
-                for i in reversed(range(0, n)):
-                    if tbuf.tokens[i].kind == "COMMENT" and \
-                       tbuf.tokens[i].first_in_line:
-                        true_fstart_token = tbuf.tokens[i]
-                        if i > 0:
-                            true_fstart_prev_token = tbuf.tokens[i - 1]
-                        else:
-                            true_fstart_prev_token = None
-                    elif tbuf.tokens[i].kind == "NEWLINE" and \
-                         tbuf.tokens[i].value.count("\n") == 1:
-                        pass
-                    else:
-                        break
-
-                if true_fstart_prev_token and \
-                   not (true_fstart_prev_token.location.line + 1 <
-                        true_fstart_token.location.line):
-                    true_fstart_prev_token.fix.add_newline = True
-                    mh.style_issue(token.location,
-                                   "function should be preceeded by an empty"
-                                   " line",
-                                   fixed)
-
-            # Make sure we have whitespace _after_ the function end
-            if valid_code and \
-               token.value == "end" and \
-               cfg.active("whitespace_around_functions") and \
-               isinstance(token.ast_link, Function_Definition):
-                # We first need to find the actual last token on this line
-                true_end_id = n
-                true_end_next = None
-                true_end_nl = None
-                for i in range(n + 1, len(tbuf.tokens)):
-                    if tbuf.tokens[i].kind == "NEWLINE":
-                        true_end_nl = tbuf.tokens[i]
-                        break
-                    elif tbuf.tokens[i].location.line == token.location.line:
-                        true_end_id = i
-                    else:
-                        break
-                true_end = tbuf.tokens[true_end_id]
-                for i in range(true_end_id + 1, len(tbuf.tokens)):
-                    if tbuf.tokens[i].kind == "NEWLINE":
-                        pass
-                    else:
-                        true_end_next = tbuf.tokens[i]
-                        break
-
-                if true_end_next and \
-                   not (true_end.location.line + 1 <
-                        true_end_next.location.line):
-                    mh.style_issue(token.location,
-                                   "function should be suceeded by an"
-                                   " empty line",
-                                   fixed)
-                    if true_end_nl:
-                        true_end_nl.fix.add_newline = True
-                    else:
-                        true_end.fix.add_newline = True
-
-        # Corresponds to the old CodeChecker CommentWhitespace rule
-        elif token.kind == "COMMENT":
-            if cfg.active("whitespace_comments"):
-                comment_char = token.raw_text[0]
-                comment_body = token.raw_text.lstrip(comment_char)
-                if re.match("^%#[a-zA-Z]", token.raw_text):
-                    # Stuff like %#codegen or %#ok are pragmas and should
-                    # not be subject to style checks
-                    pass
-
-                elif token.raw_text.startswith("%|"):
-                    # This is a miss-hit pragma, but we've not
-                    # processed it. This is fine.
-                    pass
-
-                elif token.block_comment:
-                    # Ignore block comments
-                    pass
-
-                elif token.raw_text.strip() in ("%s%s" % (cc, cb)
-                                                for cc in tbuf.comment_char
-                                                for cb in "{}"):
-                    # Leave block comment indicators alone
-                    pass
-
-                elif re.match("^%# +[a-zA-Z]", token.raw_text):
-                    # This looks like a pragma, but there is a spurious
-                    # space
-                    mh.style_issue(token.location,
-                                   "MATLAB pragma must not contain whitespace "
-                                   "between %# and the pragma",
-                                   fixed)
-                    token.raw_text = "%#" + token.raw_text[2:].strip()
-
-                elif re.match("^% +#[a-zA-Z]", token.raw_text):
-                    # This looks like a pragma that got "fixed" before we
-                    # fixed our pragma handling
-                    mh.style_issue(token.location,
-                                   "MATLAB pragma must not contain whitespace "
-                                   "between % and the pragma",
-                                   fixed)
-                    token.raw_text = "%#" + token.raw_text.split("#", 1)[1]
-
-                elif comment_body and not comment_body.startswith(" "):
-                    # Normal comments should contain whitespace
-                    mh.style_issue(token.location,
-                                   "comment body must be separated with "
-                                   "whitespace from the starting %s" %
-                                   comment_char,
-                                   fixed)
-                    token.raw_text = (comment_char * (len(token.raw_text) -
-                                                      len(comment_body)) +
-                                      " " +
-                                      comment_body)
-
-                # Make sure we have whitespace before each comment
-                if prev_in_line and ws_before == 0:
-                    mh.style_issue(token.location,
-                                   "comment must be preceeded by whitespace",
-                                   fixed)
-                    token.fix.ensure_ws_before = True
-
-        elif token.kind == "CONTINUATION":
-            # Make sure we have whitespace before each line continuation
-            if cfg.active("whitespace_continuation") and \
-               prev_in_line and ws_before == 0:
-                mh.style_issue(token.location,
-                               "continuation must be preceeded by whitespace",
-                               fixed)
-                token.fix.ensure_ws_before = True
-
-            if cfg.active("operator_after_continuation") and \
-               next_token and next_token.first_in_line and \
-               next_token.kind == "OPERATOR" and \
-               next_token.fix.binary_operator:
-                # Continuations should not start with operators unless
-                # its a unary.
-                mh.style_issue(next_token.location,
-                               "continuations should not start with binary "
-                               "operators")
-
-            if cfg.active("useless_continuation"):
-                if next_token and next_token.kind in ("NEWLINE", "COMMENT"):
-                    # Continuations followed immediately by a new-line
-                    # or comment are not actually helpful at all.
-                    mh.style_issue(token.location,
-                                   "useless line continuation",
-                                   fixed)
-                    token.fix.replace_with_newline = True
-                elif prev_token and prev_token.fix.statement_terminator:
-                    mh.style_issue(token.location,
-                                   "useless line continuation",
-                                   fixed)
-                    token.fix.delete = True
-
-        elif token.kind == "OPERATOR":
-            if not cfg.active("operator_whitespace"):
-                pass
-            elif token.fix.unary_operator:
-                if (prev_in_line and ws_before > 0) and \
-                   token.value in (".'", "'"):
-                    mh.style_issue(token.location,
-                                   "suffix operator must not be preceeded by"
-                                   " whitespace",
-                                   fixed)
-                    token.fix.ensure_trim_before = True
-                elif (next_in_line and ws_after > 0) and \
-                     token.value not in (".'", "'"):
-                    mh.style_issue(token.location,
-                                   "unary operator must not be followed by"
-                                   " whitespace",
-                                   fixed)
-                    token.fix.ensure_trim_after = True
-            elif token.fix.binary_operator:
-                if token.value in (".^", "^"):
-                    if (prev_in_line and ws_before > 0) or \
-                       (next_in_line and ws_after > 0):
-                        mh.style_issue(token.location,
-                                       "power binary operator"
-                                       " must not be surrounded by whitespace",
-                                       fixed)
-                        token.fix.ensure_trim_before = True
-                        token.fix.ensure_trim_after = True
-                else:
-                    if (prev_in_line and ws_before == 0) or \
-                       (next_in_line and ws_after == 0):
-                        mh.style_issue(token.location,
-                                       "non power binary operator"
-                                       " must be surrounded by whitespace",
-                                       fixed)
-                        token.fix.ensure_ws_before = True
-                        token.fix.ensure_ws_after = True
-
-            if valid_code and \
-               cfg.active("implicit_shortcircuit") and \
-               token.value in ("&", "|") and \
-               token.ast_link and \
-               isinstance(token.ast_link, Binary_Logical_Operation) and \
-               token.ast_link.short_circuit:
-                # This rule is *disabled* for now since it does not
-                # work in all circumstances. Curiously, this bug is
-                # shared by mlint which also mis-classifies & when
-                # applied to arrays.
-                #
-                # To fix this we need to perform semantic analysis and
-                # type inference. We're leaving this in for
-                # compatibility with miss_hit.cfg files that contain
-                # reference to this rules.
-                #
-                # mh.style_issue(token.location,
-                #                "implicit short-circuit operation due to"
-                #                " expression being contained in "
-                #                " if/while guard",
-                #                True)
-                # token.fix.make_shortcircuit_explicit = True
-                pass
-
-        elif token.kind == "ANNOTATION":
-            if cfg.active("annotation_whitespace"):
-                token.fix.ensure_ws_after = True
-
-                if next_in_line and ws_after == 0:
-                    mh.style_issue(token.location,
-                                   "annotation indication must be succeeded"
-                                   " by whitespace",
-                                   fixed)
-
-        elif token.kind == "NEWLINE":
-            if n == 0 and cfg.active("no_starting_newline"):
-                # Files should not *start* with newline(s)
-                mh.style_issue(token.location,
-                               "files should not start with a newline",
-                               fixed)
-                token.fix.delete = True
+        handler = handlers.get(kind)
+        if handler:
+            handler(token,
+                    Token_Neighbourhood(n,
+                                        prev_token, next_token,
+                                        prev_in_line, next_in_line,
+                                        ws_before, ws_after))
 
         # Check some specific problems with continuations
-        if token.fix.flag_continuations and \
+        if fix.flag_continuations and \
            next_in_line and next_in_line.kind == "CONTINUATION":
             continuation_is_fixed = False
-            token.fix.add_newline = False
-            if cfg.active("dangerous_continuation"):
+            fix.add_newline = False
+            if chk_dangerous_continuation:
                 next_in_line.fix.replace_with_newline = True
                 continuation_is_fixed = True
             mh.style_issue(next_in_line.location,
@@ -807,9 +1050,7 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
                            fixed and continuation_is_fixed)
 
         # Complain about indentation
-        if valid_code and \
-           cfg.active("indentation") and \
-           token.kind != "NEWLINE":
+        if check_indent and kind != "NEWLINE":
             # Normally we ignore block comments, but the opening token
             # _is_ checked, as that one should align somehow.
             if token.first_in_line and not (token.block_comment and
@@ -823,7 +1064,7 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
 
                 elif bracket_stack and \
                      bracket_stack[-1].kind in relevant_brackets and \
-                     token.kind != "ANNOTATION":
+                     kind != "ANNOTATION":
                     # For stuff inside a bracket group we care about,
                     # we align it with the opening brace + 1, except
                     # for the closing brace, that one we align exactly
@@ -835,7 +1076,7 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
                         offset = bracket_stack[-1].location.col_start - \
                             statement_start_token.location.col_start
 
-                    if token.kind not in ("KET", "M_KET", "C_KET"):
+                    if kind not in ("KET", "M_KET", "C_KET"):
                         offset += 1
 
                 else:
@@ -843,35 +1084,31 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
                     # the offset. We work out how much extra space
                     # this token has based on the statement
                     # starting token.
-                    offset = token.location.col_start - \
-                        statement_start_token.location.col_start
-
-                    if offset <= 0 and not token.annotation:
-                        # If positive, we can just add it. If 0 or
-                        # negative, then we add 1/2 tabs to continue
-                        # the line, since previously it was not offset
-                        # at all.
-                        offset = cfg.style_config["tab_width"] // 2
-                    elif token.annotation:
-                        # However, for annotations, the correct offset
-                        # is to always align with the opening %|
+                    if token.annotation:
+                        # For annotations, the correct offset is to
+                        # always align with the opening %|
                         # token. Ideally we will also do indentation
                         # for the stuff inside annotation block, but
                         # since we just have pragmas right now, this
                         # can wait. But this will be nasty. :(
                         offset = 0
+                    else:
+                        # If positive, we can just add it. If 0 or
+                        # negative, then we add 1/2 tabs to continue
+                        # the line, since previously it was not offset
+                        # at all.
+                        offset = loc.col_start - \
+                            statement_start_token.location.col_start
+                        if offset <= 0:
+                            offset = continuation_offset
+
+                correct_spaces = tab_width * current_indent + offset
+                fix.correct_indent = correct_spaces
 
-                correct_spaces = (cfg.style_config["tab_width"] *
-                                  current_indent +
-                                  offset)
-                token.fix.correct_indent = correct_spaces
-
-                if token.location.col_start != correct_spaces:
-                    mh.style_issue(token.location,
-                                   "indentation not correct, should be"
-                                   " %u spaces, not %u" %
-                                   (correct_spaces,
-                                    token.location.col_start),
+                if loc.col_start != correct_spaces:
+                    mh.style_issue(loc,
+                                   indentation_message(correct_spaces,
+                                                       loc.col_start),
                                    fixed)
 
         # Keep track of matrix and cell expressions. Again, required
@@ -879,24 +1116,22 @@ def stage_3_analysis(mh, cfg, tbuf, is_embedded, fixed, valid_code):
         # chance to deal with the closing brackets while knowing the
         # opening brace, and the opening braces considering the
         # context we're currently in.
-        if token.kind in ("M_BRA", "C_BRA", "BRA"):
+        if kind in ("M_BRA", "C_BRA", "BRA"):
             bracket_stack.append(token)
-        elif token.kind in ("M_KET", "C_KET", "KET"):
+        elif kind in ("M_KET", "C_KET", "KET"):
             bracket_stack.pop()
 
         # Finally, check for unicode problems.
-        if cfg.active("unicode") and \
-           (cfg.style_config["enforce_encoding_comments"] or
-            token.kind not in ("COMMENT", "CONTINUATION")):
+        if chk_unicode and \
+           (encode_comments or kind not in ("COMMENT", "CONTINUATION")):
             try:
-                token.raw_text.encode(cfg.style_config["enforce_encoding"])
+                token.raw_text.encode(encoding)
             except UnicodeEncodeError as uee:
-                new_location = copy(token.location)
-                new_location.col_start = token.location.col_start + uee.start
-                new_location.col_end = token.location.col_start + (uee.end - 1)
+                new_location = copy(loc)
+                new_location.col_start = loc.col_start + uee.start
+                new_location.col_end = loc.col_start + (uee.end - 1)
                 mh.style_issue(new_location,
-                               "non-%s character in source" %
-                               cfg.style_config["enforce_encoding"])
+                               "non-%s character in source" % encoding)
 
 
 def check_copyright(mh, cfg, parse_tree, is_embedded):
@@ -975,10 +1210,11 @@ def check_copyright(mh, cfg, parse_tree, is_embedded):
 
     if allowed_entities:
         for n_info in n_docstring.copyright_info:
-            if n_info.get_org() not in allowed_entities:
+            org = n_info.get_org()
+            if org not in allowed_entities:
                 mh.style_issue(n_info.loc_org(),
                                "Copyright entity '%s' is not %s"
-                               % (n_info.get_org(), choices))
+                               % (org, choices))
 
 
 def stage_4_analysis(mh, cfg, parse_tree, is_embedded):
@@ -1007,7 +1243,7 @@ class MH_Style(command_line.MISS_HIT_Back_End):
 
         # Build rule library
 
-        rule_lib = build_library(wp.cfg, rule_set)
+        rule_lib = get_library(wp.cfg, rule_set)
 
         # Load file content
 
@@ -1023,7 +1259,7 @@ class MH_Style(command_line.MISS_HIT_Back_End):
 
         # We're dealing with an empty file here. Lets just not do anything
 
-        if len(lexer.text.strip()) == 0:
+        if not lexer.text or lexer.text.isspace():
             return MH_Style_Result(wp)
 
         # Stage 1 - rules around the file itself
@@ -1036,12 +1272,13 @@ class MH_Style(command_line.MISS_HIT_Back_End):
 
         # Stage 2 - rules around raw text lines
 
-        for line_no, line in enumerate(lexer.context_line, 1):
-            for rule in rule_lib["on_line"]:
-                rule.apply(wp.mh, wp.cfg,
-                           lexer.filename,
-                           line_no,
-                           line)
+        # We process one rule at a time over all lines; since
+        # messages are sorted before they are emitted the order we
+        # find them in does not matter.
+        for rule in rule_lib["on_line"]:
+            rule.apply_batch(wp.mh, wp.cfg,
+                             lexer.filename,
+                             lexer.context_line)
 
         # Tabs are just super annoying, and they require special
         # treatment. There is a known but obscure bug here, in that tabs
@@ -1126,7 +1363,7 @@ class MH_Style(command_line.MISS_HIT_Back_End):
                             fatal=False)
             else:
                 # TODO: call modify()
-                wp.write_modified(tbuf.replay())
+                wp.write_modified(tbuf.replay_iter())
 
         # Return results
 
@@ -1227,6 +1464,10 @@ def main_handler():
 
     if options.debug_dump_tree:
         extra_options["fd_tree"] = open(options.debug_dump_tree, "w")
+        # The open (and already buffered) dump file cannot be sent to
+        # worker processes, and the dump should be in a stable order
+        # anyway.
+        options.single = True
 
     style_backend = MH_Style()
     command_line.execute(mh, options, extra_options,
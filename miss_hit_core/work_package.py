@@ -3,7 +3,7 @@
 ##                                                                          ##
 ##          MATLAB Independent, Small & Safe, High Integrity Tools          ##
 ##                                                                          ##
-##              Copyright (C) 2020-2021, Florian Schanda                    ##
+##              Copyright (C) 2020-2026, Florian Schanda                    ##
 ##                                                                          ##
 ##  This file is part of MISS_HIT.                                          ##
 ##                                                                          ##
@@ -96,10 +96,11 @@ class MATLAB_File_WP(MATLAB_Work_Package):
         self.cfg = cfg_tree.get_config(self.filename)
 
     def write_modified(self, content):
-        assert isinstance(content, str)
+        # The content is an iterable of strings, which we stream to
+        # the file.
         self.modified = True
         with open(self.filename, "w", encoding=self.encoding) as fd:
-            fd.write(content)
+            fd.writelines(content)
 
     def get_content(self):
         # First we try to read the file with the suggested encoding.
@@ -155,10 +156,9 @@ class Embedded_MATLAB_WP(MATLAB_Work_Package):
         self.simulink_wp = simulink_wp
 
     def write_modified(self, content):
-        assert isinstance(content, str)
         self.modified = True
         self.simulink_wp.modified = True
-        self.block.set_text(content)
+        self.block.set_text("".join(content))
 
     def get_content(self):
         return self.block.get_text()
@@ -0,0 +1,8 @@
+% (c) Copyright 2026 Florian Schanda
+
+% Trailing tab
+potato;	
+
+% Also not OK on empty lines
+	
+% end of test